@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 import os
 import pickle
@@ -15,6 +15,15 @@ from flask_migrate import Migrate
 import joblib
 from tensorflow.keras.preprocessing.image import load_img, img_to_array
 from tensorflow.keras.applications.resnet50 import ResNet50, preprocess_input
+import uuid
+import csv
+import io
+import threading
+import time
+from contextlib import contextmanager
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 # ---------------- App Setup ----------------
 
@@ -23,6 +32,11 @@ app.secret_key = 'replace_with_a_secure_secret'   # replace in production
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.permanent_session_lifetime = timedelta(days=7)
+app.config['ARCHIVE_AFTER_DAYS'] = 90          # rows older than this move to Parquet
+app.config['ARCHIVE_BATCH_SIZE'] = 5000
+app.config['ML_MAX_CONCURRENT'] = 2            # model calls running at once, per ML route
+app.config['ML_MAX_QUEUE'] = 8                 # requests allowed to wait for a slot
+app.config['ML_QUEUE_TIMEOUT'] = 10            # seconds a request may wait before 503
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
@@ -151,6 +165,296 @@ def daily_weather_alert():
 
 
 
+# ---------------- Archival: hot/cold tiering ----------------
+# Old rows are moved out of SQLite into date-partitioned Parquet files:
+#   archive/<table>/date=YYYY-MM-DD/part-<token>-<i>.parquet
+# iter_records() reads both tiers so analytics/exports see every row.
+ARCHIVE_DIR = os.path.join(BASE_DIR, "archive")
+
+
+class ArchiveLock:
+    """
+    Readers-writer lock between the two tiers' users: a read over both tiers
+    holds it shared for its whole duration, each archive batch holds it
+    exclusively. An export can't miss rows moved mid-stream. In-process only.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+
+    @contextmanager
+    def reading(self):
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._cond:
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+ARCHIVE_LOCK = ArchiveLock()
+
+_ARROW_TYPES = {
+    db.Integer: pa.int64(),
+    db.Float: pa.float64(),
+    db.Boolean: pa.bool_(),
+    db.DateTime: pa.timestamp("us"),
+}
+
+DATE_PARTITIONING = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+
+
+def archive_schema(model):
+    """
+    Arrow schema for a model's archived rows (string for text columns).
+    """
+    fields = []
+    for col in model.__table__.columns:
+        arrow_type = next((t for sa_type, t in _ARROW_TYPES.items()
+                           if isinstance(col.type, sa_type)), pa.string())
+        fields.append(pa.field(col.name, arrow_type))
+    return pa.schema(fields)
+
+
+def _archive_path(model):
+    return os.path.join(ARCHIVE_DIR, model.__tablename__)
+
+
+def _row_dict(row):
+    return {col.name: getattr(row, col.name) for col in row.__table__.columns}
+
+
+def _row_key(row):
+    # SQLite reuses ids once the newest row is deleted, so id alone is not unique
+    # across tiers; (id, timestamp) is.
+    return row["id"], row["timestamp"]
+
+
+def _archive_dataset(model):
+    """
+    Open a model's archive with the current model schema, so partitions written
+    before a column was added still scan (the new column reads as null).
+    """
+    schema = archive_schema(model).append(pa.field("date", pa.string()))
+    return ds.dataset(_archive_path(model), format="parquet",
+                      schema=schema, partitioning=DATE_PARTITIONING)
+
+
+def _archived_keys(model, records):
+    """
+    Return the (id, timestamp) keys of `records` already present in the archive.
+    Both predicates are pushed down, so only the batch's date partitions are read.
+    """
+    if not os.path.isdir(_archive_path(model)):
+        return set()
+    dates = pa.array(sorted({r["timestamp"].strftime("%Y-%m-%d") for r in records}), pa.string())
+    ids = pa.array([r["id"] for r in records], pa.int64())
+    found = _archive_dataset(model).to_table(
+        columns=["id", "timestamp"],
+        filter=ds.field("date").isin(dates) & ds.field("id").isin(ids))
+    return {_row_key(r) for r in found.to_pylist()}
+
+
+def archive_model(model, cutoff, batch_size=None):
+    """
+    Move rows of `model` with timestamp < cutoff to Parquet. Returns rows moved.
+    Pending queries stay in the hot table so agronomists can still answer them.
+
+    Each batch is written first and deleted from SQLite only after the write
+    succeeds. Rows a previous run already wrote (it died before the delete)
+    are found in the archive and only deleted, so no row is archived twice.
+    """
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    eligible = model.query.filter(model.timestamp < cutoff)
+    if model is Query:
+        eligible = eligible.filter(Query.status != "Pending")
+
+    moved = 0
+    while True:
+        with ARCHIVE_LOCK.writing():
+            count = _archive_batch(model, eligible, batch_size)
+        if not count:
+            break
+        moved += count
+    return moved
+
+
+def _archive_batch(model, eligible, batch_size):
+    """Move one batch of eligible rows; returns how many rows left the hot table."""
+    rows = eligible.order_by(model.id).limit(batch_size).all()
+    if not rows:
+        return 0
+
+    records = [_row_dict(r) for r in rows]
+    archived = _archived_keys(model, records)
+    fresh = [r for r in records if _row_key(r) not in archived]
+
+    written = []
+    if fresh:
+        table = pa.Table.from_pylist(fresh, schema=archive_schema(model))
+        table = table.append_column(
+            "date", pa.array([r["timestamp"].strftime("%Y-%m-%d") for r in fresh], pa.string()))
+        ds.write_dataset(
+            table,
+            _archive_path(model),
+            format="parquet",
+            partitioning=DATE_PARTITIONING,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            file_visitor=lambda f: written.append(f.path),
+        )
+
+    try:
+        ids = [r["id"] for r in records]
+        model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        for path in written:
+            os.remove(path)
+        raise
+    return len(records)
+
+
+def archive_cold_records():
+    """
+    Scheduled job: move SmsLog, CropHealth and Query rows older than
+    ARCHIVE_AFTER_DAYS into the Parquet archive.
+    """
+    with app.app_context():
+        cutoff = datetime.utcnow() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+        for model in (SmsLog, CropHealth, Query):
+            try:
+                moved = archive_model(model, cutoff)
+                print(f"✅ Archived {moved} {model.__tablename__} rows older than {cutoff:%Y-%m-%d}")
+            except Exception as e:
+                print(f"❌ Archiving {model.__tablename__} failed: {e}")
+
+
+def _owner_filter(model, username=None, location=None):
+    """
+    Return (column, select) restricting `model` to rows owned by the matching
+    users, or None when neither filter is given. The select is used as a SQL
+    subquery, so a large location never turns into a huge IN (...) list.
+    SmsLog has no username column, so it is filtered on mobile numbers instead.
+    """
+    if username is None and location is None:
+        return None
+    column = "username" if hasattr(model, "username") else "to_number"
+    users = db.select(User.username if column == "username" else User.mobile)
+    if username is not None:
+        users = users.where(User.username == username)
+    if location is not None:
+        users = users.where(db.func.lower(User.location) == location.strip().lower())
+    return column, users
+
+
+def iter_cold_batches(model, start=None, end=None, username=None, location=None, batch_size=None):
+    """
+    Yield lists of archived row dicts. Date bounds prune `date=` partitions and
+    all predicates are pushed down into the Parquet scan. Rows still in the hot
+    table (an interrupted archive batch) are skipped here and read from there.
+    """
+    path = _archive_path(model)
+    if not os.path.isdir(path):
+        return
+
+    filters = []
+    if start:
+        filters += [ds.field("date") >= start.strftime("%Y-%m-%d"), ds.field("timestamp") >= start]
+    if end:
+        filters += [ds.field("date") <= end.strftime("%Y-%m-%d"), ds.field("timestamp") < end]
+    owner = _owner_filter(model, username, location)
+    if owner is not None:
+        column, users = owner
+        values = db.session.execute(users).scalars().all()
+        if not values:
+            return  # no matching users, so no rows can match
+        value_set = pa.array(values, type=archive_schema(model).field(column).type)
+        filters.append(ds.field(column).isin(value_set))
+
+    expr = None
+    for f in filters:
+        expr = f if expr is None else expr & f
+
+    columns = archive_schema(model).names
+    scanner = _archive_dataset(model).scanner(
+        columns=columns, filter=expr,
+        batch_size=batch_size or app.config['ARCHIVE_BATCH_SIZE'])
+    for batch in scanner.to_batches():
+        rows = batch.to_pylist()
+        if not rows:
+            continue
+        still_hot = set(db.session.query(model.id, model.timestamp)
+                                  .filter(model.id.in_([r["id"] for r in rows])))
+        rows = [r for r in rows if _row_key(r) not in still_hot]
+        if rows:
+            yield rows
+
+
+def iter_hot_batches(model, start=None, end=None, username=None, location=None, batch_size=None):
+    """
+    Yield lists of row dicts still in the database, same filters as the cold tier.
+    Uses keyset pagination: one short query per batch, so no cursor (and no
+    SQLite read lock) stays open while a slow consumer handles the batch.
+    """
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    q = model.query
+    if start:
+        q = q.filter(model.timestamp >= start)
+    if end:
+        q = q.filter(model.timestamp < end)
+    owner = _owner_filter(model, username, location)
+    if owner is not None:
+        column, users = owner
+        q = q.filter(getattr(model, column).in_(users))
+
+    last_id = 0
+    while True:
+        rows = q.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        yield [_row_dict(r) for r in rows]
+
+
+def iter_record_batches(model, start=None, end=None, username=None, location=None, batch_size=None):
+    """
+    Read path over both tiers: archived batches first (oldest), then hot ones.
+    `end` is exclusive. Holds ARCHIVE_LOCK shared until exhausted or closed,
+    so archive batches wait instead of moving rows the read already passed.
+    """
+    with ARCHIVE_LOCK.reading():
+        for tier in (iter_cold_batches, iter_hot_batches):
+            yield from tier(model, start, end, username, location, batch_size)
+
+
+def iter_records(model, start=None, end=None, username=None, location=None, batch_size=None):
+    """
+    Same as iter_record_batches(), one row dict at a time.
+    """
+    for batch in iter_record_batches(model, start, end, username, location, batch_size):
+        yield from batch
+
+
 # ---------------- Updated send_sms function ----------------
 def send_sms(mobile: str, message: str):
     """
@@ -455,6 +759,115 @@ def reply_query():
 
     flash("✅ Reply sent successfully!", "success")
     return redirect(url_for("agronomist_dashboard"))
+
+# ---------------- Admission Control for ML routes ----------------
+class AdmissionRejected(Exception):
+    """Raised when an ML pool sheds a request; answered with 503 + Retry-After."""
+    def __init__(self, retry_after):
+        super().__init__("Server busy, please retry shortly.")
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """
+    Caps how many model calls run at once. Extra requests wait in a bounded
+    queue for at most `queue_timeout` seconds; when the queue is full or the
+    wait times out the caller is rejected instead of piling onto the CPU.
+    Use as `with limiter:` around the model call only.
+    """
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    def acquire(self):
+        """Return True once a slot is held, False if the request should be shed."""
+        with self._cond:
+            if self.active < self.max_concurrent and self.waiting == 0:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected_queue_full += 1
+                return False
+
+            self.waiting += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected_timeout += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        if not self.acquire():
+            raise AdmissionRejected(max(1, int(self.queue_timeout)))
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "active": self.active,
+                "queue_depth": self.waiting,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_timeout": self.rejected_timeout,
+            }
+
+
+def _ml_limiter(name):
+    return ConcurrencyLimiter(name,
+                              app.config['ML_MAX_CONCURRENT'],
+                              app.config['ML_MAX_QUEUE'],
+                              app.config['ML_QUEUE_TIMEOUT'])
+
+
+# One pool per ML route; DB/template routes are never limited so they keep
+# the remaining server threads even while the model pools are saturated.
+# Only the model call holds a slot: auth checks, uploads and weather lookups don't.
+ADMISSION_POOLS = {
+    "predict": _ml_limiter("predict"),
+    "soil_prediction": _ml_limiter("soil_prediction"),
+}
+
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    return (jsonify({"error": str(e)}),
+            503, {"Retry-After": str(e.retry_after)})
+
+
+@app.route('/metrics/admission')
+def admission_metrics():
+    """Queue depth and rejection counters for each ML pool."""
+    return jsonify({name: limiter.stats() for name, limiter in ADMISSION_POOLS.items()})
+
+
 # ---------------- Helper Function ----------------
 def predict_leaf(img_path):
     """
@@ -502,7 +915,8 @@ def predict_crop():
             file.save(file_path)
 
             # Predict crop health with the file path inside POST block
-            main_status = predict_leaf(file_path)
+            with ADMISSION_POOLS["predict"]:
+                main_status = predict_leaf(file_path)
             session["last_crop_health"] = main_status
 
             # Save result in database
@@ -520,6 +934,9 @@ def predict_crop():
                 uploaded_image=url_for('static', filename=f'uploads/{filename}')
             )
 
+        except AdmissionRejected:
+            os.remove(file_path)  # shed before prediction; don't keep the upload
+            raise
         except Exception as e:
             print("Prediction error:", e)
             flash(f"Error processing image: {str(e)}", 'error')
@@ -562,7 +979,8 @@ def soil_prediction():
         features = np.array([[weather["temp"], weather["rainfall"], fertilizer,
                               nitrogen, phosphorus, potassium, soil_encoded]])
 
-        prediction = crop_model.predict(features)[0]
+        with ADMISSION_POOLS["soil_prediction"]:
+            prediction = crop_model.predict(features)[0]
         recommendation = f"Recommended Crop: {prediction}"
 
     return render_template("soil_prediction.html",
@@ -685,10 +1103,121 @@ def fetch_crop_images():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+# ---------------- Data Export (CSV / Parquet) ----------------
+EXPORT_MODELS = {model.__tablename__: model for model in (CropHealth, SoilData, Query, SmsLog)}
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only file object that buffers bytes until drained, so a ParquetWriter
+    can be streamed out one row group at a time.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_csv(model, batches):
+    """
+    Yield CSV text: header first, then one chunk per row batch.
+    """
+    columns = archive_schema(model).names
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    yield buf.getvalue()
+    for batch in batches:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(batch)
+        yield buf.getvalue()
+
+
+def stream_parquet(model, batches):
+    """
+    Yield Parquet bytes, one row group per row batch.
+    """
+    schema = archive_schema(model)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for batch in batches:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d") if value else None
+
+
+@app.route('/export/<table>')
+def export_data(table):
+    """
+    Stream a table (hot + archived rows) as CSV or Parquet.
+    Query params: format=csv|parquet, start/end=YYYY-MM-DD (inclusive), location.
+    """
+    if session.get('role', '').lower() != 'agronomist':
+        return jsonify({"error": "Unauthorized"}), 403
+
+    model = EXPORT_MODELS.get(table)
+    if model is None:
+        return jsonify({"error": f"Unknown table '{table}'",
+                        "tables": sorted(EXPORT_MODELS)}), 404
+
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in ('csv', 'parquet'):
+        return jsonify({"error": "format must be 'csv' or 'parquet'"}), 400
+
+    try:
+        start = _parse_date(request.args.get('start'))
+        end = _parse_date(request.args.get('end'))
+    except ValueError:
+        return jsonify({"error": "start/end must be YYYY-MM-DD"}), 400
+    if end:
+        end += timedelta(days=1)  # make the end date inclusive
+    location = request.args.get('location') or None
+
+    batches = iter_record_batches(model, start=start, end=end, location=location)
+    if fmt == 'csv':
+        body, mimetype = stream_csv(model, batches), 'text/csv'
+    else:
+        body, mimetype = stream_parquet(model, batches), 'application/vnd.apache.parquet'
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={table}.{fmt}"}
+    )
+
 # ---------------- Run App ----------------
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()  # Recreate tables with new columns
+    scheduler = APScheduler()
+    scheduler.init_app(app)
+    scheduler.add_job(id='archive_cold_records', func=archive_cold_records,
+                      trigger='cron', hour=2, minute=0)
+    scheduler.start()
     app.run(debug=True, use_reloader=False)
 
 